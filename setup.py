@@ -14,7 +14,7 @@ setup(
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
     python_requires='>=3.7',
-    install_requires=['scipy', "importlib_resources", "numpy"],
+    install_requires=['scipy', "importlib_resources", "numpy", "numba"],
     packages=find_namespace_packages(where='src'),
     package_dir={'': 'src'},
     package_data={"population_structure": ['*.dll', '*.so'],
@@ -1,5 +1,5 @@
 import numpy as np
-from ..helper_funcs.helper_funcs import comb
+from ..helper_funcs.helper_funcs import comb, off_diagonal_columns
 import scipy as sp
 
 
@@ -53,10 +53,7 @@ class Coalescence:
         ls_sol = sp.optimize.lsq_linear(A, b, bounds=(bounds[0], bounds[1]), max_iter=1000)
         x = ls_sol.x
         # norm = 0.5 * np.linalg.norm(A @ x - b, ord=2) ** 2
-        for i in range(n):
-            start_ind = i * (n - 1)
-            M[i, 0:i] = x[start_ind:start_ind + i]
-            M[i, i + 1:n] = x[start_ind + i:start_ind + n - 1]
+        M[np.arange(n)[:, None], off_diagonal_columns(n)] = x[:n ** 2 - n].reshape(n, n - 1)
         return M, ls_sol
 
     def produce_coefficient_mat(self) -> np.ndarray:
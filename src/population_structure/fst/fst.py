@@ -1,7 +1,7 @@
 import numpy as np
 from scipy.optimize import minimize
-from ..helper_funcs.helper_funcs import compute_coalescence, comb, constraint_generator, f_to_m, \
-    cons_migration_constraint_generator
+from ..helper_funcs.helper_funcs import compute_coalescence, compute_coalescence_jac, comb, constraint_generator, \
+    f_to_m, f_to_m_jac, cons_migration_constraint_generator, pair_indices, off_diagonal_columns
 
 
 class Fst:
@@ -31,32 +31,29 @@ class Fst:
                        is (min, max) pair of the corresponding variable. If bounds is a tuple of two scalars,
                        the same bounds are applied for each variable.
         :return: A tuple: (A possible corresponding Coalescence time matrix- T, details about
-                          the solution of the numerical solver).
+                          the solution of the numerical solver). solution.fun is the squared norm ||R||^2 of
+                          Slatkin's equations at the solution, not the norm.
         """
         n, nc2 = self.shape, comb(self.shape, 2)
         if x0 is None:
             x0 = np.random.uniform(low=0, high=2 * n, size=(n + nc2,))
         T = np.zeros((n, n))
-        f_values = self.matrix[np.triu_indices(n, 1)]
+        row_indices, col_indices = pair_indices(n)
+        f_values = self.matrix[row_indices, col_indices]
+        f_ratio = (1 + f_values) / (1 - f_values)
         # add constraints
         constraints = None
         if constraint:
             constraints = []
-            row, col = 0, 1
-            for i in range(nc2):
-                constraint_1 = constraint_generator(i, nc2 + row)
-                constraint_2 = constraint_generator(i, nc2 + col)
-                col += 1
+            for i in range(nc2):  # T(row,col) must be larger than T(row,row) and T(col,col)
+                constraint_1 = constraint_generator(i, nc2 + row_indices[i])
+                constraint_2 = constraint_generator(i, nc2 + col_indices[i])
                 constraints.append({"type": "ineq", "fun": constraint_1})
                 constraints.append({"type": "ineq", "fun": constraint_2})
-                if col == n:  # move to next row
-                    row += 1
-                    col = row + 1
-        solution = minimize(compute_coalescence, x0=x0, args=(f_values, n), bounds=(n + nc2) * [(bounds[0], bounds[1])],
-                            constraints=constraints)
+        solution = minimize(compute_coalescence, x0=x0, args=(f_ratio, n), jac=compute_coalescence_jac, tol=1e-12,
+                            bounds=(n + nc2) * [(bounds[0], bounds[1])], constraints=constraints)
         x = solution.x
         np.fill_diagonal(T, x[nc2:])
-        row_indices, col_indices = np.triu_indices(n, 1)
         T[(row_indices, col_indices)] = x[0:nc2]
         T[(col_indices, row_indices)] = x[0:nc2]
         return T, solution
@@ -72,19 +69,17 @@ class Fst:
                               does not guarantee that the migration matrix will be conservative!
         :return: A tuple (matrix, solution).
                 One possible corresponding migration matrix, according to W.H and Slatkin's equations, and details
-                about the solution of the numerical solver.
+                about the solution of the numerical solver. solution.fun is the squared norm ||R||^2 of the
+                equations at the solution, not the norm.
         """
         n, nc2 = self.shape, comb(self.shape, 2)
         if x0 is None:
             x0 = np.random.uniform(low=0, high=2 * n, size=(n ** 2,))
         M = np.zeros((n, n))
-        f_values = self.matrix.flatten()
+        f_ratio = (1 + self.matrix) / (1 - self.matrix)
         bnds = (n ** 2 - n) * [(bounds[0], bounds[1])] + n * [(0, np.inf)]
-        solution = minimize(f_to_m, x0=x0, args=(f_values, n, conservative), method="SLSQP",
+        solution = minimize(f_to_m, x0=x0, args=(f_ratio, n, conservative), jac=f_to_m_jac, method="SLSQP", tol=1e-12,
                             bounds=bnds)
         x = solution.x
-        for i in range(n):
-            start_ind = i * (n - 1)
-            M[i, 0:i] = x[start_ind:start_ind + i]
-            M[i, i + 1:n] = x[start_ind + i:start_ind + n - 1]
+        M[np.arange(n)[:, None], off_diagonal_columns(n)] = x[:n ** 2 - n].reshape(n, n - 1)
         return M, solution
@@ -1,7 +1,11 @@
 import math
 import numpy as np
 import scipy as sp
-from collections import deque
+from functools import lru_cache
+from numba import njit
+from scipy.sparse.csgraph import connected_components
+
+MAX_DIAMETER_BROADCAST_SIZE = 2 ** 24  # max number of elements for the all-pairs difference tensor in diameter
 
 
 def comb(n: int, k: int) -> int:
@@ -11,72 +15,210 @@ def comb(n: int, k: int) -> int:
     :param k: number of selected objects
     :return: n Choose k
     """
-    return int(math.factorial(n) / (math.factorial(k) * math.factorial(n - k)))
+    return math.comb(n, k)
+
+
+@lru_cache(maxsize=32)
+def pair_indices(n: int) -> tuple:
+    """
+    returns the row and column indices of the upper triangle (without the diagonal) of an n x n matrix, in the order
+    of the pairs [(1,2),(1,3),...,(1,n),(2,3),...,(n-1,n)]. The arrays are cached per n and are read-only.
+    :param n: matrix size (number of populations).
+    :return: A tuple (ii, jj) of index arrays, each of size nC2.
+    """
+    ii, jj = np.triu_indices(n, k=1)
+    ii.flags.writeable = False
+    jj.flags.writeable = False
+    return ii, jj
+
+
+@lru_cache(maxsize=32)
+def off_diagonal_columns(n: int) -> np.ndarray:
+    """
+    returns an (n, n-1) array where row i holds the columns [0,...,i-1,i+1,...,n-1], which is the order of the M_{i,k}
+    unknowns in the flattened migration vector. The array is cached per n and is read-only.
+    :param n: matrix size (number of populations).
+    :return: The (n, n-1) array of off-diagonal column indices.
+    """
+    cols = np.tile(np.arange(n - 1), (n, 1))
+    cols += cols >= np.arange(n)[:, None]  # skip the diagonal column
+    cols.flags.writeable = False
+    return cols
 
 
-def compute_coalescence(t: np.ndarray, f: np.ndarray, n: int) -> float:
+@njit(cache=True, fastmath=True)
+def _compute_coalescence_core(t: np.ndarray, f_ratio: np.ndarray, n: int, grad: np.ndarray) -> float:
+    """
+    compiled core of compute_coalescence and compute_coalescence_jac. Returns the sum of squares of Slatkin's
+    equations. If grad is not empty, J^T R (R is the vector of equations and J its Jacobian) is added to it.
+    """
+    nC2 = n * (n - 1) // 2
+    with_grad = grad.size > 0
+    ssq = 0.0
+    k = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            eq = t[k] - 0.5 * (t[nC2 + i] + t[nC2 + j]) * f_ratio[k]
+            ssq += eq * eq
+            if with_grad:  # the equation depends only on T(i,j), T(i,i) and T(j,j)
+                grad[k] += eq
+                grad[nC2 + i] -= 0.5 * f_ratio[k] * eq
+                grad[nC2 + j] -= 0.5 * f_ratio[k] * eq
+            k += 1
+    return ssq
+
+
+def compute_coalescence(t: np.ndarray, f_ratio: np.ndarray, n: int) -> float:
     """
     returns the equations that describe the connection between coalescent times and Fst
     of all populations 1,2...n (Slatkin). These are the equations to minimize in order to find possible T matrices.
     :param t: an array representing [T(1,2),T(1,3)...,T(1,n),T(2,3)...,T(2,n),...T(1,1),T(2,2),...,T(n,n)], which are
               the variables to solve. Size of the array(number of unknowns) in nC2 + n.
-    :param f: array of Fst values [F(1,2),F(1,3),,,,F(1,n),F(2,3),...F(2,n),...F(n-1,n)]. Array size is nC2.
+    :param f_ratio: array of (1 + F) / (1 - F) for the Fst values
+                    [F(1,2),F(1,3),,,,F(1,n),F(2,3),...F(2,n),...F(n-1,n)]. Array size is nC2. The ratio is constant
+                    during the minimization, so it is computed once by the caller.
     :param n: number of populations.
-    :return: A list of all the equations that describe the connection between coalescent times and Fst
+    :return: The squared norm of all the equations that describe the connection between coalescent times and Fst
              of all populations 1,2...n (Slatkin).
     """
-    eqs_lst = []
-    nC2 = comb(n, 2)
-    k = 0
-    for i in range(nC2):
-        for j in range(i + 1, n):
-            eq = t[k] - (0.5 * (t[nC2 + i] + t[nC2 + j]) * ((1 + f[k]) / (1 - f[k])))
-            eqs_lst.append(eq)
-            k += 1
-    return float(np.linalg.norm(eqs_lst))
+    return _compute_coalescence_core(np.asarray(t, dtype=np.float64), np.asarray(f_ratio, dtype=np.float64), n,
+                                     np.empty(0))
 
 
-def f_to_m(u: np.ndarray, f: np.ndarray, n: int, conservative=True) -> float:
+def compute_coalescence_jac(t: np.ndarray, f_ratio: np.ndarray, n: int) -> np.ndarray:
     """
-    Function to minimize in order to solve F->M directly, including conservative migration constraints (Xiran's paper).
-    :param f: vector of Fst values (parameters) of size nC2.
-    :param u: vector of unknown T and M values of size n^2.
+    returns the analytic gradient of compute_coalescence, to be passed as the 'jac' argument of the minimize algorithm.
+    :param t: the variables, same as in compute_coalescence.
+    :param f_ratio: (1 + F) / (1 - F) for the Fst values, same as in compute_coalescence.
     :param n: number of populations.
-    :param conservative: whether to add conservative migration constraints.
-    :return: value of function at point u.
-    """
-    equation_lst = []
-    m = u[:n ** 2 - n]  # M values
-    t = u[n ** 2 - n:]  # T values
-    indices = np.vstack(np.indices((n, n))).reshape(2, -1).T
-    mask = indices[:, 0] != indices[:, 1]  # Off-diagonal mask
-    m_matrix = np.zeros((n, n))
-    m_matrix[tuple(indices[mask].T)] = m
+    :return: The gradient of compute_coalescence at point t.
+    """
+    grad = np.zeros(len(t))
+    _compute_coalescence_core(np.asarray(t, dtype=np.float64), np.asarray(f_ratio, dtype=np.float64), n, grad)
+    return 2 * grad
+
+
+@njit(cache=True, fastmath=True)
+def _f_to_m_core(u: np.ndarray, f_ratio: np.ndarray, n: int, conservative: bool, grad: np.ndarray) -> float:
+    """
+    compiled core of f_to_m and f_to_m_jac. Returns the sum of squares of the equations. If grad is not empty,
+    J^T R (R is the vector of equations and J its Jacobian) is added to it. The unknowns M_{i,k} of row i are stored at
+    u[(n-1)*i: (n-1)*i + n-1] (skipping k=i), and T_{i,i} is stored at u[n^2-n+i].
+    """
+    n_m = n * n - n
+    with_grad = grad.size > 0
+    m_sums = np.zeros(n)
+    for i in range(n):
+        for k in range(n - 1):
+            m_sums[i] += u[(n - 1) * i + k]
+    ssq = 0.0
     for i in range(n):
-        incoming_migrants_i = m[(n - 1) * i: (n - 1) * i + n - 1]  # only unknowns of kind M_{i,k}
-        m_i = np.sum(incoming_migrants_i)
-        other_t = np.concatenate((t[:i], t[i + 1:]))  # only unknowns of kind T_{k,k} where k!=i
-        f_i_values = np.concatenate((f[n * i: n * i + i],
-                                     f[n * i + 1 + i: n * i + n]))  # only f value of kind F_{i,k} where k!=i
-        ones = np.ones(n - 1)
-        f_i_vector = (ones + f_i_values) / (ones - f_i_values)
-        equation_lst.append(((1 + m_i) * t[i] - 0.5 * (incoming_migrants_i @ ((other_t + t[i]) * f_i_vector))) - 1)
+        t_i = u[n_m + i]
+        acc = 0.0
+        pos = 0
+        for k in range(n):  # sum over M_{i,k} * (T_{i,i} + T_{k,k}) * (1 + F_{i,k}) / (1 - F_{i,k}) where k!=i
+            if k == i:
+                continue
+            acc += u[(n - 1) * i + pos] * (u[n_m + k] + t_i) * f_ratio[i, k]
+            pos += 1
+        eq = (1 + m_sums[i]) * t_i - 0.5 * acc - 1
+        ssq += eq * eq
+        if with_grad:
+            d_t_i = 1 + m_sums[i]
+            pos = 0
+            for k in range(n):
+                if k == i:
+                    continue
+                m_ik = u[(n - 1) * i + pos]
+                grad[(n - 1) * i + pos] += (t_i - 0.5 * (t_i + u[n_m + k]) * f_ratio[i, k]) * eq
+                grad[n_m + k] -= 0.5 * m_ik * f_ratio[i, k] * eq
+                d_t_i -= 0.5 * m_ik * f_ratio[i, k]
+                pos += 1
+            grad[n_m + i] += d_t_i * eq
         for j in range(i):
-            incoming_migrants_j = m[(n - 1) * j: (n - 1) * j + n - 1]
-            m_j = np.sum(incoming_migrants_j)
-            f_j_values = np.concatenate((f[n * j: n * j + i],
-                                         f[n * j + 1 + i: n * j + n]))
-            f_i_new_values = np.concatenate((f[n * i: n * i + j],
-                                             f[n * i + 1 + j: n * i + n]))
-            f_j_vector = (ones + f_j_values) / (ones - f_j_values)
-            f_i_new_vector = (ones + f_i_new_values) / (ones - f_i_new_values)
-            t_vals_no_j = np.concatenate((t[:j], t[j + 1:]))
-            equation_lst.append(0.25 * (((m_i + m_j) * (t[i] + t[j]) * ((1 + f[(n * i + j)]) / (1 - f[(n * i + j)]))) -
-                                        (incoming_migrants_i @ ((other_t + t[j]) * f_j_vector))
-                                        - (incoming_migrants_j @ ((t_vals_no_j + t[i]) * f_i_new_vector))) - 1)
+            t_j = u[n_m + j]
+            s_ij = (t_i + t_j) * f_ratio[i, j]
+            acc = (m_sums[i] + m_sums[j]) * s_ij
+            pos = 0
+            for k in range(n):  # M_{i,k} * (T_{j,j} + T_{k,k}) * (1 + F_{j,k}) / (1 - F_{j,k}) where k!=i
+                if k == i:
+                    continue
+                acc -= u[(n - 1) * i + pos] * (u[n_m + k] + t_j) * f_ratio[j, k]
+                pos += 1
+            pos = 0
+            for k in range(n):  # M_{j,k} * (T_{i,i} + T_{k,k}) * (1 + F_{i,k}) / (1 - F_{i,k}) where k!=j
+                if k == j:
+                    continue
+                acc -= u[(n - 1) * j + pos] * (u[n_m + k] + t_i) * f_ratio[i, k]
+                pos += 1
+            eq = 0.25 * acc - 1
+            ssq += eq * eq
+            if with_grad:
+                d_t = 0.25 * (m_sums[i] + m_sums[j]) * f_ratio[i, j]
+                grad[n_m + i] += d_t * eq
+                grad[n_m + j] += d_t * eq
+                pos = 0
+                for k in range(n):
+                    if k == i:
+                        continue
+                    grad[(n - 1) * i + pos] += 0.25 * (s_ij - (u[n_m + k] + t_j) * f_ratio[j, k]) * eq
+                    c = 0.25 * u[(n - 1) * i + pos] * f_ratio[j, k] * eq
+                    grad[n_m + k] -= c
+                    grad[n_m + j] -= c
+                    pos += 1
+                pos = 0
+                for k in range(n):
+                    if k == j:
+                        continue
+                    grad[(n - 1) * j + pos] += 0.25 * (s_ij - (u[n_m + k] + t_i) * f_ratio[i, k]) * eq
+                    c = 0.25 * u[(n - 1) * j + pos] * f_ratio[i, k] * eq
+                    grad[n_m + k] -= c
+                    grad[n_m + i] -= c
+                    pos += 1
         if conservative:  # add conservative migration constraint for row i
-            equation_lst.append(np.sum(m_matrix[i, :]).round(2) - np.sum(m_matrix[:, i]).round(2))
-    return float(np.linalg.norm(equation_lst))
+            col_sum = 0.0
+            for j in range(n):  # M_{j,i} sits at position i of row j if i < j, and i-1 otherwise
+                if j == i:
+                    continue
+                col_sum += u[(n - 1) * j + (i if i < j else i - 1)]
+            eq = m_sums[i] - col_sum
+            ssq += eq * eq
+            if with_grad:
+                for k in range(n - 1):
+                    grad[(n - 1) * i + k] += eq
+                for j in range(n):
+                    if j == i:
+                        continue
+                    grad[(n - 1) * j + (i if i < j else i - 1)] -= eq
+    return ssq
+
+
+def f_to_m(u: np.ndarray, f_ratio: np.ndarray, n: int, conservative=True) -> float:
+    """
+    Function to minimize in order to solve F->M directly, including conservative migration constraints (Xiran's paper).
+    :param f_ratio: n x n matrix of (1 + F) / (1 - F) for the Fst matrix F (parameters). The ratio is constant during
+                    the minimization, so it is computed once by the caller.
+    :param u: vector of unknown T and M values of size n^2.
+    :param n: number of populations.
+    :param conservative: whether to add conservative migration constraints.
+    :return: value of function at point u, which is the squared norm of the equations.
+    """
+    return _f_to_m_core(np.asarray(u, dtype=np.float64), np.asarray(f_ratio, dtype=np.float64), n, bool(conservative),
+                        np.empty(0))
+
+
+def f_to_m_jac(u: np.ndarray, f_ratio: np.ndarray, n: int, conservative=True) -> np.ndarray:
+    """
+    returns the analytic gradient of f_to_m, to be passed as the 'jac' argument of the minimize algorithm.
+    :param u: vector of unknown T and M values of size n^2.
+    :param f_ratio: n x n matrix of (1 + F) / (1 - F) for the Fst matrix F, same as in f_to_m.
+    :param n: number of populations.
+    :param conservative: whether to add conservative migration constraints.
+    :return: The gradient of f_to_m at point u.
+    """
+    grad = np.zeros(len(u))
+    _f_to_m_core(np.asarray(u, dtype=np.float64), np.asarray(f_ratio, dtype=np.float64), n, bool(conservative), grad)
+    return 2 * grad
 
 
 def constraint_generator(i: int, j: int) -> callable:
@@ -100,30 +242,24 @@ def cons_migration_constraint_generator(n: int, i: int) -> callable:
     :return: A callable which is the conservative migration constraint for population i
     """
 
+    row_slice_i = slice((n - 1) * i, (n - 1) * (i + 1))  # positions of M_{i,k} where k!=i
+    cols_for_row_i = np.flatnonzero(off_diagonal_columns(n) == i)  # positions of M_{j,i} where j!=i
+
     def constraint(x: np.ndarray):
-        m_values = x[:n ** 2 - n]
-        indices = np.vstack(np.indices((n, n))).reshape(2, -1).T
-        mask = indices[:, 0] != indices[:, 1]  # Off-diagonal mask
-        m = np.zeros((n, n))
-        m[tuple(indices[mask].T)] = m_values
-        vec = []
-        for j in range(n):
-            vec.append(np.sum(m[j, :]).round(2) - np.sum(m[:, j]).round(2))
-        return np.linalg.norm(vec)
-        # return np.sum(m[i, :]).round(2) - np.sum(m[:, i]).round(2)
+        return x[row_slice_i].sum() - x[cols_for_row_i].sum()
 
     return constraint
 
 
 def check_constraint(t: np.ndarray) -> bool:
     """
-    gets a T matrix and returns True if it follows the within < inbetween constraint.
+    gets a T matrix and returns True if it follows the within <= inbetween constraint (ties are allowed).
     :param t: Coalescence times matrix.
     :return: True if t follows the constraint, False otherwise.
     """
-    min_indices = t.argmin(axis=1)
-    diag_indices = np.diag_indices(t.shape[0])[0]
-    return not np.any(min_indices != diag_indices)
+    off_diag = t.astype(float)  # a copy, so that the diagonal can be masked out
+    np.fill_diagonal(off_diag, np.inf)
+    return bool((np.diag(t) <= off_diag.min(axis=1, initial=np.inf)).all())
 
 
 def check_conservative(m: np.ndarray):
@@ -132,10 +268,19 @@ def check_conservative(m: np.ndarray):
     :param m: A migration matrix
     :return: True if m is conservative, False otherwise.
     """
-    for i in range(m.shape[0]):
-        if np.sum(m[i, :]).round(2) != np.sum(m[:, i]).round(2):
-            return False
-    return True
+    return bool(np.allclose(m.sum(axis=1), m.sum(axis=0), atol=5e-3))
+
+
+@njit(cache=True, fastmath=True)
+def _l1_sum(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    compiled single pass sum of |a - b| over two matrices of the same shape, without a temporary difference matrix.
+    """
+    s = 0.0
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            s += abs(a[i, j] - b[i, j])
+    return s
 
 
 def migration_matrix_distance(a: np.ndarray, b: np.ndarray) -> float:
@@ -145,9 +290,11 @@ def migration_matrix_distance(a: np.ndarray, b: np.ndarray) -> float:
     :param b: second matrix.
     :return: The distance between a and b.
     """
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
     n = a.shape[0]
-    c = np.abs(a - b)
-    return float(np.sum(c)) / (n ** 2 - n)
+    if a.ndim != 2 or a.shape != b.shape:  # the kernel does no bounds checking, let numpy broadcast or raise
+        return float(np.sum(np.abs(a - b))) / (n ** 2 - n)
+    return _l1_sum(a, b) / (n ** 2 - n)
 
 
 def fst_matrix_distance(a: np.ndarray, b: np.ndarray) -> float:
@@ -166,21 +313,28 @@ def diameter(mats: list) -> float:
     :param mats: list containing a set of matrices of the same shape.
     :return: The diameter (maximum pair-wise distance) of the set of matrices 'mats'.
     """
-    max_diam = 0
-    for i in range(len(mats)):
-        for j in range(i):
-            max_diam = max(max_diam, migration_matrix_distance(mats[i], mats[j]))
-    return max_diam
+    k = len(mats)
+    if k < 2:
+        return 0
+    stacked = np.stack(mats)  # (k, n, n)
+    n = stacked.shape[1]
+    if k * k * stacked[0].size <= MAX_DIAMETER_BROADCAST_SIZE:
+        # (k, k) pair-wise distances, symmetric and non-negative with a zero diagonal, so its max is the max pair
+        max_dist = np.abs(stacked[:, None] - stacked[None, :]).sum(axis=(2, 3)).max()
+    else:  # the (k, k, n, n) tensor is too large, broadcast one matrix against the rest instead
+        max_dist = max(np.abs(stacked[i] - stacked[i + 1:]).sum(axis=(1, 2)).max() for i in range(k - 1))
+    return float(max_dist) / (n ** 2 - n)
 
 
 def matrix_mean(mats: list) -> np.ndarray:
     """
     returns matrix which is the mean of a set of matrices, meaning each entry of the matrix is the mean of the entry
     across all matrices.
-    :param mats: a set of matrices.
+    :param mats: a set of matrices, either a list of matrices or a 3-D numpy array.
     :return: matrix mean.
     """
-    return np.sum(mats, axis=0) / len(mats)
+    stacked = mats if isinstance(mats, np.ndarray) else np.stack(mats)
+    return stacked.mean(axis=0)
 
 
 def find_components(matrix: np.ndarray) -> dict[int, list[int]]:
@@ -190,31 +344,27 @@ def find_components(matrix: np.ndarray) -> dict[int, list[int]]:
     :return: A dictionary where the keys are the connected components' indices and the values are lists of the vertices
             in the connected component.
     """
-    components = 1
-    n = matrix.shape[0]
-    queue = deque()
-    visited = set()
-    not_visited = set([i for i in range(1, n)])
-    visited.add(0)
-    comp_dict = {components: [0]}
-    queue.append(0)
-    while len(not_visited) != 0:
-        while len(queue) != 0:
-            cur_vertex = queue.popleft()
-            for i in range(n):
-                if i not in visited and (matrix[cur_vertex, i] != 0 or matrix[i, cur_vertex] != 0):
-                    queue.append(i)
-                    visited.add(i)
-                    not_visited.remove(i)
-                    comp_dict[components].append(i)
-        for vertex in not_visited:
-            components += 1
-            queue.append(vertex)
-            visited.add(vertex)
-            not_visited.remove(vertex)
-            comp_dict[components] = [vertex]
-            break
-    return comp_dict
+    # weak connectivity: vertices are connected if there is migration in either direction
+    n_components, labels = connected_components(sp.sparse.csr_matrix(matrix), directed=True, connection="weak")
+    # group the vertices by label in one pass, a stable sort keeps the vertices of each component in ascending order
+    vertices_by_label = np.argsort(labels, kind="stable")
+    split_points = np.cumsum(np.bincount(labels, minlength=n_components))[:-1]
+    components = np.split(vertices_by_label, split_points)
+    return {label + 1: component.tolist() for label, component in enumerate(components)}
+
+
+def _contiguous_slice(indices: np.ndarray):
+    """
+    returns a slice equivalent to the given indices if they are a non-empty consecutive ascending range, so that the
+    matching sub-matrix can be accessed with basic slicing instead of np.ix_.
+    :param indices: 1-D integer array of vertex indices.
+    :return: slice(first, last + 1) if indices is a consecutive range, None otherwise.
+    """
+    if len(indices) == 0 or indices[-1] - indices[0] + 1 != len(indices):
+        return None
+    if not np.array_equal(indices, np.arange(indices[0], indices[-1] + 1)):
+        return None
+    return slice(int(indices[0]), int(indices[-1]) + 1)
 
 
 def split_migration_matrix(migration_matrix: np.ndarray, connected_components: list) -> list:
@@ -227,10 +377,14 @@ def split_migration_matrix(migration_matrix: np.ndarray, connected_components: l
              in order to interpret which populations are described in each sub-matrix the connected components list
              is needed.
     """
+    comp_arrays = [np.asarray(component, dtype=np.intp) for component in connected_components]
     sub_matrices = []
-    for component in connected_components:
-        sub_matrix = migration_matrix[np.ix_(component, component)]
-        sub_matrices.append(sub_matrix)
+    for component in comp_arrays:
+        block = _contiguous_slice(component)
+        if block is not None:
+            sub_matrices.append(migration_matrix[block, block].copy())
+        else:
+            sub_matrices.append(migration_matrix[np.ix_(component, component)])
 
     return sub_matrices
 
@@ -259,14 +413,15 @@ def reassemble_matrix(sub_matrices: list, connected_components: list, matrix_typ
     :return: The assembled Fst or Coalescence matrix.
     """
     num_nodes = sum(len(component) for component in connected_components)
-    if matrix_type == "fst":
-        adjacency_matrix = np.ones((num_nodes, num_nodes), dtype=float)
-    else:
-        adjacency_matrix = np.full((num_nodes, num_nodes), np.inf)
-
+    fill_value = 1.0 if matrix_type == "fst" else np.inf
+    adjacency_matrix = np.full((num_nodes, num_nodes), fill_value)
     for component, sub_matrix in zip(connected_components, sub_matrices):
-        indices = np.array(component)
-        adjacency_matrix[np.ix_(indices, indices)] = sub_matrix
+        indices = np.asarray(component, dtype=np.intp)
+        block = _contiguous_slice(indices)
+        if block is not None:
+            adjacency_matrix[block, block] = sub_matrix
+        else:
+            adjacency_matrix[np.ix_(indices, indices)] = sub_matrix
 
     return adjacency_matrix
 
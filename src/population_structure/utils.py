@@ -104,7 +104,8 @@ def f_to_t(f: np.ndarray, x0=None, constraint=False, bounds=(0, np.inf)) -> tupl
                   first is lower bounds for each variable, second is upper bounds for each variable.
                   If bounds is a tuple of two scalars, the same bounds are applied for each variable.
     :return: A tuple: (A possible corresponding Coalescence time matrix- T, details about
-                      the solution of the numerical solver).
+                      the solution of the numerical solver). solution.fun is the squared norm ||R||^2 of Slatkin's
+                      equations at the solution, not the norm.
     """
     Fst_matrix = Fst(f)
     return Fst_matrix.produce_coalescence(x0, constraint, bounds)
@@ -137,7 +138,8 @@ def f_to_m(f: np.ndarray, x0=None, constraint=False, bounds_t=(0, np.inf), bound
     :return: A tuple: first element is a possible corresponding migration matrix, second element is details about
                       the solution. If indirect is True, these are the details of the solution of the T->M
                       transformation which uses Linear Least Squares. Otherwise, these are the details of the numeric
-                      solver that solves the F->M directly.
+                      solver that solves the F->M directly, where solution.fun is the squared norm ||R||^2 of the
+                      equations at the solution, not the norm.
     """
     if indirect:
         T_matrix = Coalescence(f_to_t(f, x0, constraint, bounds_t)[0])